@@ -0,0 +1,123 @@
+import functools
+import json
+import os
+import boto3
+import botocore
+from botocore.config import Config
+
+# CONFIG
+CLIENT_CONFIG = Config(
+    max_pool_connections=25,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=60,
+)
+
+# poll cluster status every 30s, give up after 20 minutes
+CLUSTER_WAITER_CONFIG = {"Delay": 30, "MaxAttempts": 40}
+
+# IAM role ARN written by create_tables.py so etl.py can skip the lookup
+ROLE_ARN_CACHE = "dwh_role_arn.json"
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(KEY: str, SECRET: str, region_name: str = "us-west-2") -> boto3.Session:
+    """
+    Description: Create a boto3 session once per set of credentials
+        so every client shares the same credential resolver.
+
+    Arguments:
+        KEY (str): AWS access key id
+        SECRET (str): AWS secret access key
+        region_name (str): AWS region
+
+    Returns:
+        boto3 session
+    """
+    return boto3.Session(
+        region_name=region_name,
+        aws_access_key_id=KEY,
+        aws_secret_access_key=SECRET,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(session: boto3.Session, service: str) -> botocore.client:
+    """
+    Description: Get a cached low-level client for `service` so
+        repeated calls reuse the client and its connection pool.
+
+    Arguments:
+        session (boto3.Session): session returned by `get_session`
+        service (str): AWS service name, e.g. "iam" or "redshift"
+
+    Returns:
+        botocore client
+    """
+    return session.client(service, config=CLIENT_CONFIG)
+
+
+@functools.lru_cache(maxsize=None)
+def get_resource(
+    session: boto3.Session, service: str
+) -> boto3.resources.base.ServiceResource:
+    """
+    Description: Get a cached resource for `service`, e.g. "ec2".
+
+    Arguments:
+        session (boto3.Session): session returned by `get_session`
+        service (str): AWS service name
+
+    Returns:
+        boto3 service resource
+    """
+    return session.resource(service, config=CLIENT_CONFIG)
+
+
+def save_role_arn(DWH_IAM_ROLE_NAME: str, roleArn: str) -> None:
+    """
+    Description: Cache the IAM role ARN in `ROLE_ARN_CACHE`.
+
+    Arguments:
+        DWH_IAM_ROLE_NAME (str): name of IAM role
+        roleArn (str): IAM role ARN
+
+    Returns:
+        None
+    """
+    with open(ROLE_ARN_CACHE, "w") as f:
+        json.dump({"RoleName": DWH_IAM_ROLE_NAME, "Arn": roleArn}, f)
+
+
+def load_role_arn(DWH_IAM_ROLE_NAME: str) -> str:
+    """
+    Description: Read the cached IAM role ARN, if it was cached
+        for the same role.
+
+    Arguments:
+        DWH_IAM_ROLE_NAME (str): name of IAM role
+
+    Returns:
+        string containing IAM role ARN, or None if not cached
+    """
+    try:
+        with open(ROLE_ARN_CACHE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("RoleName") != DWH_IAM_ROLE_NAME:
+        return None
+    return cached.get("Arn")
+
+
+def clear_role_arn() -> None:
+    """
+    Description: Remove the cached IAM role ARN, if any.
+
+    Returns:
+        None
+    """
+    if os.path.exists(ROLE_ARN_CACHE):
+        os.remove(ROLE_ARN_CACHE)
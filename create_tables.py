@@ -1,12 +1,22 @@
 import logging
+import sys
 import psycopg2
 import configparser
-import boto3
 import json
 import botocore
-import psycopg2.extensions as psycopg2Ext
-
-from sql_queries import create_table_queries, drop_table_queries
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from botocore.exceptions import WaiterError
+
+from aws_clients import (
+    CLUSTER_WAITER_CONFIG,
+    get_session,
+    get_client,
+    get_resource,
+    save_role_arn,
+)
+from db_config import DB_CONNECTION_OPTIONS
+from sql_queries import create_table_queries, create_table_specs, drop_table_queries
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +59,7 @@ def get_role_arn(
         if e.response["Error"]["Code"] == "EntityAlreadyExists":
             pass
         else:
-            msg = "ERROR: Could not create IAM Role."
+            msg = "ERROR: Could not create IAM Role: %s"
             logger.warning(msg, e)
             return
 
@@ -60,21 +70,37 @@ def get_role_arn(
     return iam.get_role(RoleName=DWH_IAM_ROLE_NAME)["Role"]["Arn"]
 
 
+@contextmanager
+def acquire(pool: ThreadedConnectionPool):
+    """
+    Description: Borrow a connection from the pool and return it
+        once the caller is done with it.
+
+    Arguments:
+        pool (ThreadedConnectionPool): connection pool
+
+    Returns:
+        connection object
+    """
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
 def create_dist_schema(
     DWH_DB_USER: str,
     schema_name: str,
-    cur: psycopg2Ext.cursor,
-    conn: psycopg2Ext.connection,
+    pool: ThreadedConnectionPool,
 ) -> None:
     """
-    Description: Create distribution schema and set search path
-        to the schema name.
+    Description: Create distribution schema in a single transaction.
 
     Arguments:
         DWH_DB_USER (str): db user name to restrict authorization
         schema_name (str): schema
-        cur (psycopg2Ext.cursor): cursor object
-        conn (psycopg2Ext.connection): connection object
+        pool (ThreadedConnectionPool): connection pool
 
     Returns:
         None
@@ -83,97 +109,92 @@ def create_dist_schema(
     queries = [
         f"DROP SCHEMA IF EXISTS {schema_name} CASCADE;",
         f"CREATE SCHEMA IF NOT EXISTS {schema_name} authorization {DWH_DB_USER };",
-        f"SET search_path TO {schema_name};",
     ]
 
-    for query in queries:
-        try:
+    query = "\n".join(queries)
+    try:
+        with acquire(pool) as conn, conn, conn.cursor() as cur:
             cur.execute(query)
-        except psycopg2.Error as e:
-            msg = f"ERROR: Issue dropping/creating schema."
-            logger.warning(msg, e)
-            return
-        conn.commit()
+    except psycopg2.Error:
+        msg = f"ERROR: Issue dropping/creating schema with query: {query}"
+        logger.exception(msg)
+        raise
 
 
-def drop_tables(cur: psycopg2Ext.cursor, conn: psycopg2Ext.connection) -> None:
+def drop_tables(pool: ThreadedConnectionPool, schema_name: str) -> None:
     """
-    Description: Drop each table using queries in
-        `drop_table_queries` list.
+    Description: Drop all tables using queries in
+        `drop_table_queries` list in the schema, sent as a single
+        transaction.
 
     Arguments:
-        cur (psycopg2Ext.cursor): cursor object
-        conn (psycopg2Ext.connection): connection object
+        pool (ThreadedConnectionPool): connection pool
+        schema_name (str): schema the tables live in
 
     Returns:
         None
     """
-    for query in drop_table_queries:
-        try:
+    # search path is session state, set it on whichever connection is borrowed
+    query = "\n".join([f"SET search_path TO {schema_name};"] + drop_table_queries)
+    try:
+        with acquire(pool) as conn, conn, conn.cursor() as cur:
             cur.execute(query)
-        except psycopg2.Error as e:
-            msg = f"ERROR: Could not drop table with query: {query}"
-            logger.warning(msg, e)
-            return
-        conn.commit()
+    except psycopg2.Error:
+        msg = f"ERROR: Could not drop tables with query: {query}"
+        logger.exception(msg)
+        raise
 
 
-def create_tables(cur: psycopg2Ext.cursor, conn: psycopg2Ext.connection) -> None:
+def create_tables(pool: ThreadedConnectionPool, schema_name: str) -> None:
     """
-    Description: Create each table using the queries in
-        `create_table_queries` list.
+    Description: Create all tables using the queries in
+        `create_table_queries` list in the schema, sent as a single
+        transaction.
 
     Arguments:
-        cur (psycopg2Ext.cursor): cursor object
-        conn (psycopg2Ext.connection): connection object
+        pool (ThreadedConnectionPool): connection pool
+        schema_name (str): schema the tables live in
 
     Returns:
         None
     """
-    for query in create_table_queries:
-        try:
+    # search path is session state, set it on whichever connection is borrowed
+    query = "\n".join([f"SET search_path TO {schema_name};"] + create_table_queries)
+    try:
+        with acquire(pool) as conn, conn, conn.cursor() as cur:
             cur.execute(query)
-        except psycopg2.Error as e:
-            msg = f"ERROR: Could not create table with query: {query}"
-            logger.warning(msg, e)
-            return
-        conn.commit()
+    except psycopg2.Error:
+        msg = f"ERROR: Could not create tables with query: {query}"
+        logger.exception(msg)
+        raise
 
 
-def test_tables(cur: psycopg2Ext.cursor, conn: psycopg2Ext.connection) -> None:
+def test_tables(pool: ThreadedConnectionPool) -> None:
     """
     Description: Test table status to make sure tables exists.
 
     Arguments:
-        cur (psycopg2Ext.cursor): cursor object
-        conn (psycopg2Ext.connection): connection object
+        pool (ThreadedConnectionPool): connection pool
 
     Returns:
         None
     """
-    print("\n==================== TEST -- table status  ====================")
+    logger.info("\n==================== TEST -- table status  ====================")
 
-    for query in create_table_queries:
-        tbl_name = query[query.find("EXISTS") + len("EXISTS") : query.find("(")].strip()
-        query = f"""select exists(select * from information_schema.tables
-            where table_name='{tbl_name}')"""
-
-        try:
-            cur.execute(query)
-        except psycopg2.Error as e:
-            msg = f"ERROR: Could not retrieve table info with query: {query}"
-            logger.warning(msg, e)
-            return
-        conn.commit()
+    query = """select exists(select * from information_schema.tables
+        where table_name=%s)"""
 
-        try:
-            tbl_status = cur.fetchone()[0]
-        except psycopg2.Error as e:
-            msg = f"ERROR: Could not fetch table status for table: {tbl_name}"
-            logger.warning(msg, e)
-            return
+    with acquire(pool) as conn, conn, conn.cursor() as cur:
+        for tbl_name, _ in create_table_specs:
+            try:
+                cur.execute(query, (tbl_name,))
+                tbl_status = cur.fetchone()[0]
+            except psycopg2.Error as e:
+                msg = f"ERROR: Could not fetch status for table {tbl_name}: %s"
+                logger.warning(msg, e)
+                return
 
-        print(f"Table '{tbl_name}' exists status: {tbl_status}.")
+            logger.info("Table '%s' exists status: %s.", tbl_name, tbl_status)
 
 
 def main():
@@ -186,6 +207,8 @@ def main():
     Returns:
         None
     """
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format="%(message)s")
+
     config = configparser.ConfigParser()
     config.read("dwh.cfg")
 
@@ -206,32 +229,24 @@ def main():
     DWH_IAM_ROLE_NAME = config.get("DWH", "DWH_IAM_ROLE_NAME")
     DWH_POLICY_ARN = config.get("DWH", "DWH_POLICY_ARN")
 
+    # setup aws session shared by all clients
+    session = get_session(KEY, SECRET)
+
     # setup iam and redshift clients
-    iam = boto3.client(
-        "iam",
-        region_name="us-west-2",
-        aws_access_key_id=KEY,
-        aws_secret_access_key=SECRET,
-    )
+    iam = get_client(session, "iam")
 
     roleArn = get_role_arn(iam, DWH_POLICY_ARN, DWH_IAM_ROLE_NAME)
 
-    redshift = boto3.client(
-        "redshift",
-        region_name="us-west-2",
-        aws_access_key_id=KEY,
-        aws_secret_access_key=SECRET,
-    )
+    # cache role ARN so etl.py can skip the IAM lookup
+    if roleArn:
+        save_role_arn(DWH_IAM_ROLE_NAME, roleArn)
+
+    redshift = get_client(session, "redshift")
 
     # setup ec2
-    ec2 = boto3.resource(
-        "ec2",
-        region_name="us-west-2",
-        aws_access_key_id=KEY,
-        aws_secret_access_key=SECRET,
-    )
+    ec2 = get_resource(session, "ec2")
 
-    print("Creating Redshift cluster...")
+    logger.info("Creating Redshift cluster...")
 
     # create Redshift cluster
     try:
@@ -249,10 +264,21 @@ def main():
         if e.response["Error"]["Code"] == "ClusterAlreadyExists":
             pass
         else:
-            msg = "ERROR: Could not create a Redshift cluster."
+            msg = "ERROR: Could not create a Redshift cluster: %s"
             logger.warning(msg, e)
             return
 
+    # wait for cluster to become available
+    try:
+        redshift.get_waiter("cluster_available").wait(
+            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
+            WaiterConfig=CLUSTER_WAITER_CONFIG,
+        )
+    except WaiterError as e:
+        msg = "ERROR: Redshift cluster did not become available: %s"
+        logger.warning(msg, e)
+        return
+
     # get cluster status
     clusterProp = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)[
         "Clusters"
@@ -260,13 +286,7 @@ def main():
 
     clusterStatus = clusterProp["ClusterStatus"]
 
-    while clusterStatus == "creating":
-        clusterProp = redshift.describe_clusters(
-            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER
-        )["Clusters"][0]
-        clusterStatus = clusterProp["ClusterStatus"]
-
-    print(f"\nCluster created successfully. Cluster status='{clusterStatus}'")
+    logger.info("\nCluster created successfully. Cluster status='%s'", clusterStatus)
 
     # cluster endpoint
     dwh_endpoint = clusterProp["Endpoint"]["Address"]
@@ -288,46 +308,49 @@ def main():
         if e.response["Error"]["Code"] == "InvalidPermission.Duplicate":
             pass
         else:
-            msg = "ERROR: Could not open incoming TCP port."
+            msg = "ERROR: Could not open incoming TCP port: %s"
             logger.warning(msg, e)
             return
 
     # connect to cluster
     try:
-        conn = psycopg2.connect(
-            f"host={dwh_endpoint} dbname={DWH_DB} user={DWH_DB_USER} \
-            password={DWH_DB_PASSWORD} port={DWH_PORT}"
+        pool = ThreadedConnectionPool(
+            1,
+            4,
+            host=dwh_endpoint,
+            dbname=DWH_DB,
+            user=DWH_DB_USER,
+            password=DWH_DB_PASSWORD,
+            port=int(DWH_PORT),
+            **DB_CONNECTION_OPTIONS,
         )
     except psycopg2.Error as e:
-        msg = "ERROR: Could not make connection to dwh."
+        msg = "ERROR: Could not make connection to dwh: %s"
         logger.warning(msg, e)
         return
 
     try:
-        cur = conn.cursor()
-    except psycopg2.Error as e:
-        msg = "ERROR: Could not get cursor to sparkify database."
-        logger.warning(msg, e)
+        logger.info("Creating schema...")
+        # create schema
+        create_dist_schema(DWH_DB_USER, SCHEMA_NAME, pool)
+        logger.info("Schema successfully created!")
+
+        # drop tables
+        drop_tables(pool, SCHEMA_NAME)
+
+        logger.info("Creating tables...")
+        # create tables
+        create_tables(pool, SCHEMA_NAME)
+        logger.info("Tables successfully created!")
+
+        # test to check if tables were created
+        test_tables(pool)
+    except psycopg2.Error:
+        # already logged by the failing step
         return
-
-    print("Creating schema...")
-    # create schema
-    create_dist_schema(DWH_DB_USER, SCHEMA_NAME, cur, conn)
-    print("Schema successfully created!")
-
-    # drop tables
-    drop_tables(cur, conn)
-
-    print("Creating tables...")
-    # create tables
-    create_tables(cur, conn)
-    print("Tables successfully created!")
-
-    # test to check if tables were created
-    test_tables(cur, conn)
-
-    # close connection
-    conn.close()
+    finally:
+        # close connections
+        pool.closeall()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,11 @@
+# CONFIG
+
+# libpq keepalives so long-running queries survive idle-connection resets
+DB_CONNECTION_OPTIONS = {
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 5,
+    "connect_timeout": 10,
+    "application_name": "cdw-etl",
+}
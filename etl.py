@@ -1,13 +1,92 @@
 import logging
+import sys
 import configparser
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
 import psycopg2
-import boto3
 import psycopg2.extensions as psycopg2Ext
-from sql_queries import copy_table_queries, insert_table_queries
+from botocore.exceptions import WaiterError
+from aws_clients import (
+    CLUSTER_WAITER_CONFIG,
+    clear_role_arn,
+    get_session,
+    get_client,
+    load_role_arn,
+)
+from db_config import DB_CONNECTION_OPTIONS
+from sql_queries import (
+    analyze_staging_table_queries,
+    analyze_table_queries,
+    copy_table_queries,
+    insert_table_queries,
+    insert_table_specs,
+    songplay_table_insert,
+    staging_events_nextsong_insert,
+    time_table_insert,
+)
 
 
 logger = logging.getLogger(__name__)
 
+# abort a COPY stuck on S3 after 1 hour (milliseconds)
+COPY_STATEMENT_TIMEOUT = 3600000
+
+# number of rows printed per table by test_queries
+TEST_SAMPLE_SIZE = 5
+
+
+def connect(conn_params: dict, SCHEMA_NAME: str) -> psycopg2Ext.connection:
+    """
+    Description: Connect to the cluster and set the search path to
+        the schema so queries can use unqualified table names.
+
+    Arguments:
+        conn_params (dict): connection parameters of the cluster
+        SCHEMA_NAME (str): schema
+
+    Returns:
+        connection object
+    """
+    conn = psycopg2.connect(**conn_params)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA_NAME};")
+    except psycopg2.Error:
+        conn.close()
+        raise
+
+    return conn
+
+
+def run_query(conn_params: dict, SCHEMA_NAME: str, query: str, error_msg: str) -> bool:
+    """
+    Description: Run a single query on its own connection, since
+        psycopg2 connections must not be shared across threads.
+
+    Arguments:
+        conn_params (dict): connection parameters of the cluster
+        SCHEMA_NAME (str): schema
+        query (str): query to run
+        error_msg (str): message logged if the query fails
+
+    Returns:
+        True if the query was committed, False otherwise
+    """
+    conn = None
+    try:
+        conn = connect(conn_params, SCHEMA_NAME)
+        with conn, conn.cursor() as cur:
+            cur.execute(query)
+    except psycopg2.Error:
+        msg = f"{error_msg} {query}"
+        logger.exception(msg)
+        return False
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return True
+
 
 def load_staging_tables(
     SCHEMA_NAME: str,
@@ -15,11 +94,13 @@ def load_staging_tables(
     S3_LOG_JSONPATH: str,
     S3_SONG_DATA: str,
     roleArn: str,
-    cur: psycopg2Ext.cursor,
-    conn: psycopg2Ext.connection,
-) -> None:
+    conn_params: dict,
+) -> bool:
     """
-    Description: Load partitoned data into the cluster.
+    Description: Load partitoned data into the cluster. Both COPY
+        commands run concurrently, each on its own connection, then
+        NextSong events are copied into `staging_events_nextsong` and
+        staging table statistics are refreshed.
 
     Arguments:
         SCHEMA_NAME (str): schema
@@ -27,92 +108,138 @@ def load_staging_tables(
         S3_LOG_JSONPATH (str): jsonpath in S3
         S3_SONG_DATA (str): song data path in S3
         roleArn (str): IAM role ARN
-        s3_buckets (Tuple[str]): tuple containing addresses of S3 buckets
-        cur (psycopg2Ext.cursor): cursor object
-        conn (psycopg2Ext.connection): connection object
+        conn_params (dict): connection parameters of the cluster
 
     Returns:
-        None
+        True if both staging tables were loaded, False otherwise
     """
     queries = [
-        copy_table_queries[0].format(
-            SCHEMA_NAME, S3_LOG_DATA, roleArn, S3_LOG_JSONPATH
-        ),
-        copy_table_queries[1].format(SCHEMA_NAME, S3_SONG_DATA, roleArn),
+        copy_table_queries[0].format(S3_LOG_DATA, roleArn, S3_LOG_JSONPATH),
+        copy_table_queries[1].format(S3_SONG_DATA, roleArn),
     ]
 
-    print("Copying data from S3 to staging Redshift tables...")
-    for query in queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error as e:
-            msg = f"ERROR: Could not copy table with query: {query}"
-            logger.warning(msg, e)
-            continue
+    logger.info("Copying data from S3 to staging Redshift tables...")
+    msg = "ERROR: Could not copy table with query:"
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                run_query,
+                conn_params,
+                SCHEMA_NAME,
+                f"SET statement_timeout TO {COPY_STATEMENT_TIMEOUT};\n{query}",
+                msg,
+            )
+            for query in queries
+        ]
+
+    if not all(future.result() for future in futures):
+        return False
+
+    # keep only NextSong events for the songplays and users inserts
+    msg = "ERROR: Could not filter staging events with query:"
+    if not run_query(conn_params, SCHEMA_NAME, staging_events_nextsong_insert, msg):
+        return False
+
+    # COPY skips statistics, refresh them so songplays can use a merge join
+    msg = "ERROR: Could not analyze staging tables with query:"
+    query = "\n".join(analyze_staging_table_queries)
+    run_query(conn_params, SCHEMA_NAME, query, msg)
+
+    return True
+
+
+def insert_tables(SCHEMA_NAME: str, conn_params: dict) -> bool:
+    """
+    Description: Insert data from staging tables to final tables.
+        Inserts that only read staging tables run concurrently;
+        the time table is filled once songplays has been loaded.
 
+    Arguments:
+        SCHEMA_NAME (str): schema
+        conn_params (dict): connection parameters of the cluster
 
-def insert_tables(cur: psycopg2Ext.cursor, conn: psycopg2Ext.connection) -> None:
+    Returns:
+        True if every insert succeeded, False otherwise
     """
-    Description: Insert data from staging tables to final tables.
+    logger.info("Inserting data from staging to final tables...")
+    queries = [query for query in insert_table_queries if query != time_table_insert]
+    msg = "ERROR: Could not insert data into table with query:"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {
+            executor.submit(run_query, conn_params, SCHEMA_NAME, query, msg): query
+            for query in queries
+        }
+        wait(futures, return_when=ALL_COMPLETED)
+
+        failed = [query for future, query in futures.items() if not future.result()]
+        if failed:
+            logger.warning(
+                "ERROR: %d of %d insert queries failed.", len(failed), len(queries)
+            )
+        if songplay_table_insert in failed:
+            return False
+
+        time_inserted = executor.submit(
+            run_query, conn_params, SCHEMA_NAME, time_table_insert, msg
+        ).result()
+
+    return time_inserted and not failed
+
+
+def analyze_tables(conn: psycopg2Ext.connection) -> None:
+    """
+    Description: Refresh planner statistics of the final tables in a
+        single transaction once all inserts have completed.
 
     Arguments:
-        cur (psycopg2Ext.cursor): cursor object
         conn (psycopg2Ext.connection): connection object
 
     Returns:
         None
     """
-    print("Inserting data from staging to final tables...")
-    for query in insert_table_queries:
-        try:
+    query = "\n".join(analyze_table_queries)
+    try:
+        with conn, conn.cursor() as cur:
             cur.execute(query)
-            conn.commit()
-        except psycopg2.Error as e:
-            msg = f"ERROR: Could not insert data into table with query: {query}"
-            logger.warning(msg, e)
-            return
+    except psycopg2.Error:
+        msg = f"ERROR: Could not analyze tables with query: {query}"
+        logger.exception(msg)
 
 
-def test_queries(
-    SCHEMA_NAME: str, cur: psycopg2Ext.cursor, conn: psycopg2Ext.connection
-) -> None:
+def test_queries(conn: psycopg2Ext.connection) -> None:
     """
     Description: Test queries to make sure data is successfully inserted.
+        Rows are streamed through a server-side cursor so at most
+        `TEST_SAMPLE_SIZE` rows per table are held in memory.
 
     Arguments:
-        SCHEMA_NAME (str): schema
-        cur (psycopg2Ext.cursor): cursor object
         conn (psycopg2Ext.connection): connection object
 
     Returns:
         None
     """
-    for query in insert_table_queries:
-        tbl_name = query[query.find("INTO") + len("INTO") : query.find("(")].strip()
-        test_query = f"SELECT * FROM {tbl_name} LIMIT 5;"
-
-        print(f"\n==================== TEST -- {tbl_name}  ====================")
-        print(f"Query: `{test_query}`")
-
-        try:
-            cur.execute(test_query)
-        except psycopg2.Error as e:
-            msg = f"Could not query table `{tbl_name}`"
-            logger.warning(msg, e)
-            conn.commit()
-            continue
+    for tbl_name, _ in insert_table_specs:
+        test_query = f"SELECT * FROM {tbl_name} LIMIT {TEST_SAMPLE_SIZE}"
 
         try:
-            data = cur.fetchall()
+            with conn.cursor(name=f"test_{tbl_name}") as sscur:
+                sscur.itersize = TEST_SAMPLE_SIZE
+                sscur.execute(test_query)
+                data = list(islice(sscur, TEST_SAMPLE_SIZE))
         except psycopg2.Error as e:
-            msg = f"Could not fetch data from table `{tbl_name}`"
+            msg = f"Could not fetch data from table `{tbl_name}`: %s"
             logger.warning(msg, e)
             conn.commit()
             continue
 
-        for row in data:
-            print(row)
+        logger.info(
+            "\n==================== TEST -- %s  ====================\n"
+            "Query: `%s`\n%s",
+            tbl_name,
+            test_query,
+            "\n".join(map(str, data)),
+        )
 
     conn.commit()
     return
@@ -129,6 +256,8 @@ def main() -> None:
     Returns:
         None
     """
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format="%(message)s")
+
     config = configparser.ConfigParser()
     config.read("dwh.cfg")
 
@@ -149,20 +278,12 @@ def main() -> None:
     S3_LOG_JSONPATH = config.get("S3", "LOG_JSONPATH")
     S3_SONG_DATA = config.get("S3", "SONG_DATA")
 
-    # setup iam client
-    iam = boto3.client(
-        "iam",
-        region_name="us-west-2",
-        aws_access_key_id=KEY,
-        aws_secret_access_key=SECRET,
-    )
+    # setup aws session shared by all clients
+    session = get_session(KEY, SECRET)
 
-    redshift = boto3.client(
-        "redshift",
-        region_name="us-west-2",
-        aws_access_key_id=KEY,
-        aws_secret_access_key=SECRET,
-    )
+    # setup iam and redshift clients
+    iam = get_client(session, "iam")
+    redshift = get_client(session, "redshift")
 
     clusterProp = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)[
         "Clusters"
@@ -171,65 +292,70 @@ def main() -> None:
     # cluster endpoint
     dwh_endpoint = clusterProp["Endpoint"]["Address"]
 
-    # connect to cluster
-    try:
-        conn = psycopg2.connect(
-            f"host={dwh_endpoint} dbname={DWH_DB} user={DWH_DB_USER} \
-            password={DWH_DB_PASSWORD} port={DWH_PORT}"
-        )
-    except psycopg2.Error as e:
-        msg = "ERROR: Could not make connection to dwh."
-        logger.warning(msg, e)
-        return
+    conn_params = dict(
+        host=dwh_endpoint,
+        dbname=DWH_DB,
+        user=DWH_DB_USER,
+        password=DWH_DB_PASSWORD,
+        port=int(DWH_PORT),
+        **DB_CONNECTION_OPTIONS,
+    )
 
+    # connect to cluster
     try:
-        cur = conn.cursor()
+        conn = connect(conn_params, SCHEMA_NAME)
     except psycopg2.Error as e:
-        msg = "ERROR: Could not get cursor to sparkify database."
+        msg = "ERROR: Could not make connection to dwh: %s"
         logger.warning(msg, e)
         return
 
-    roleArn = iam.get_role(RoleName=DWH_IAM_ROLE_NAME)["Role"]["Arn"]
+    # role ARN is cached by create_tables.py
+    roleArn = load_role_arn(DWH_IAM_ROLE_NAME)
+    if not roleArn:
+        roleArn = iam.get_role(RoleName=DWH_IAM_ROLE_NAME)["Role"]["Arn"]
 
     # load staging tables
-    load_staging_tables(
-        SCHEMA_NAME, S3_LOG_DATA, S3_LOG_JSONPATH, S3_SONG_DATA, roleArn, cur, conn
+    loaded = load_staging_tables(
+        SCHEMA_NAME, S3_LOG_DATA, S3_LOG_JSONPATH, S3_SONG_DATA, roleArn, conn_params
     )
 
-    # insert from staging to fact/dim tables
-    insert_tables(cur, conn)
+    # insert from staging to fact/dim tables and refresh their statistics
+    if not loaded:
+        logger.warning("ERROR: Staging load failed, skipping inserts.")
+    elif insert_tables(SCHEMA_NAME, conn_params):
+        analyze_tables(conn)
 
     # test queries
-    test_queries(SCHEMA_NAME, cur, conn)
+    test_queries(conn)
 
     conn.close()
 
-    print("Deleting cluster...")
+    logger.info("Deleting cluster...")
 
     # delete cluster
     redshift.delete_cluster(
         ClusterIdentifier=DWH_CLUSTER_IDENTIFIER, SkipFinalClusterSnapshot=True
     )
-    clusterProp = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)[
-        "Clusters"
-    ][0]
-    clusterStatus = clusterProp["ClusterStatus"]
-
-    while clusterStatus == "deleting":
-        try:
-            clusterProp = redshift.describe_clusters(
-                ClusterIdentifier=DWH_CLUSTER_IDENTIFIER
-            )["Clusters"][0]
-            clusterStatus = clusterProp["ClusterStatus"]
-        except Exception:
-            break
 
-    print(f"Cluster deleted successfully.")
+    # wait for cluster to be deleted
+    try:
+        redshift.get_waiter("cluster_deleted").wait(
+            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
+            WaiterConfig=CLUSTER_WAITER_CONFIG,
+        )
+    except WaiterError as e:
+        msg = "ERROR: Redshift cluster was not deleted: %s"
+        logger.warning(msg, e)
+    else:
+        logger.info("Cluster deleted successfully.")
 
     # detach role policy and delete role
     iam.detach_role_policy(RoleName=DWH_IAM_ROLE_NAME, PolicyArn=DWH_POLICY_ARN)
     iam.delete_role(RoleName=DWH_IAM_ROLE_NAME)
 
+    # drop cached role ARN along with the role
+    clear_role_arn()
+
 
 if __name__ == "__main__":
     main()
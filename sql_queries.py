@@ -1,15 +1,8 @@
-import configparser
-
-# CONFIG
-config = configparser.ConfigParser()
-config.read("dwh.cfg")
-
-SCHEMA_NAME = config.get("AWS", "SCHEMA_NAME")
-
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
-staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
+staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs;"
+staging_events_nextsong_table_drop = "DROP TABLE IF EXISTS staging_events_nextsong;"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays cascade;"
 user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
@@ -22,12 +15,17 @@ staging_events_table_create = """CREATE TABLE IF NOT EXISTS staging_events \
     (artist varchar, auth varchar, firstName varchar, gender char, itemInSession int,\
     lastName varchar, length float, level varchar, location varchar, method varchar, \
     page varchar,registration timestamp, sessionId int, song varchar, status int, \
-    ts timestamp, userAgent varchar, userId int);"""
+    ts timestamp, userAgent varchar, userId int) \
+    distkey(artist) compound sortkey(artist, song);"""
+
+staging_events_nextsong_table_create = """CREATE TABLE IF NOT EXISTS \
+    staging_events_nextsong (LIKE staging_events);"""
 
 staging_songs_table_create = """CREATE TABLE IF NOT EXISTS staging_songs \
     (num_songs int, artist_id varchar, artist_latitude float, \
     artist_longitude float, artist_location varchar, artist_name varchar,\
-    song_id varchar, title varchar, duration float, year int);"""
+    song_id varchar, title varchar, duration float, year int) \
+    distkey(artist_name) compound sortkey(artist_name, title);"""
 
 songplay_table_create = """CREATE TABLE IF NOT EXISTS songplays \
     (songplay_id int IDENTITY(0,1) PRIMARY KEY distkey, \
@@ -54,69 +52,92 @@ time_table_create = """CREATE TABLE IF NOT EXISTS time \
 # STAGING TABLES
 
 staging_events_copy = """
-copy {}.staging_events from '{}'
+copy staging_events from '{}'
 iam_role '{}'
 json '{}'
 timeformat 'epochmillisecs'
-region 'us-west-2';
+region 'us-west-2'
+compupdate off statupdate off;
 """
 
 staging_songs_copy = """
-copy {}.staging_songs from '{}'
+copy staging_songs from '{}'
 iam_role '{}'
 json 'auto'
-region 'us-west-2';
+region 'us-west-2'
+compupdate off statupdate off;
 """
 
+staging_events_nextsong_insert = """INSERT INTO staging_events_nextsong \
+    SELECT * FROM staging_events WHERE page='NextSong';"""
+
 # FINAL TABLES
 
-songplay_table_insert = f"""INSERT INTO {SCHEMA_NAME}.songplays \
+songplay_table_insert = """INSERT INTO songplays \
     (start_time, user_id, level, song_id, artist_id, session_id, \
     location, user_agent) SELECT \
-    staging_events.ts as start_time, \
-    staging_events.userId as user_id, \
-    staging_events.level as level, \
+    staging_events_nextsong.ts as start_time, \
+    staging_events_nextsong.userId as user_id, \
+    staging_events_nextsong.level as level, \
     staging_songs.song_id as song_id, \
     staging_songs.artist_id as artist_id, \
-    staging_events.sessionId as session_id, \
-    staging_events.location as location, \
-    staging_events.userAgent as user_agent \
-    FROM {SCHEMA_NAME}.staging_events \
-    JOIN {SCHEMA_NAME}.staging_songs \
-    ON (staging_events.artist=staging_songs.artist_name AND \
-        staging_events.song=staging_songs.title)
-    WHERE staging_events.page='NextSong';"""
-
-user_table_insert = f"""INSERT INTO {SCHEMA_NAME}.users \
+    staging_events_nextsong.sessionId as session_id, \
+    staging_events_nextsong.location as location, \
+    staging_events_nextsong.userAgent as user_agent \
+    FROM staging_events_nextsong \
+    JOIN staging_songs \
+    ON (staging_events_nextsong.artist=staging_songs.artist_name AND \
+        staging_events_nextsong.song=staging_songs.title);"""
+
+user_table_insert = """INSERT INTO users \
     (user_id, first_name, last_name, gender, level) SELECT \
-    DISTINCT(staging_events.userId) as user_id, \
-    staging_events.firstName as first_name, \
-    staging_events.lastName as last_name, \
-    staging_events.gender as gender, \
-    staging_events.level as level \
-    FROM {SCHEMA_NAME}.staging_events
-    WHERE user_id IS NOT NULL AND staging_events.page='NextSong';"""
-
-
-song_table_insert = f"""INSERT INTO {SCHEMA_NAME}.songs \
+    user_id, first_name, last_name, gender, level FROM ( \
+        SELECT \
+        staging_events_nextsong.userId as user_id, \
+        staging_events_nextsong.firstName as first_name, \
+        staging_events_nextsong.lastName as last_name, \
+        staging_events_nextsong.gender as gender, \
+        staging_events_nextsong.level as level, \
+        ROW_NUMBER() OVER (PARTITION BY staging_events_nextsong.userId \
+            ORDER BY staging_events_nextsong.ts DESC) as rn \
+        FROM staging_events_nextsong \
+        WHERE staging_events_nextsong.userId IS NOT NULL) AS latest_users \
+    WHERE rn = 1;"""
+
+song_table_insert = """INSERT INTO songs \
     (song_id, title, artist_id, year, duration) SELECT \
-    DISTINCT(staging_songs.song_id) as song_id, \
-    staging_songs.title as title, \
-    staging_songs.artist_id as artist_id, \
-    staging_songs.year as year, \
-    staging_songs.duration as duration \
-    FROM {SCHEMA_NAME}.staging_songs;"""
-
-artist_table_insert = f"""INSERT INTO {SCHEMA_NAME}.artists \
+    song_id, title, artist_id, year, duration FROM ( \
+        SELECT \
+        staging_songs.song_id as song_id, \
+        staging_songs.title as title, \
+        staging_songs.artist_id as artist_id, \
+        staging_songs.year as year, \
+        staging_songs.duration as duration, \
+        ROW_NUMBER() OVER (PARTITION BY staging_songs.song_id \
+            ORDER BY staging_songs.year DESC NULLS LAST, \
+            staging_songs.duration DESC NULLS LAST, \
+            staging_songs.title, staging_songs.artist_id) as rn \
+        FROM staging_songs) AS unique_songs \
+    WHERE rn = 1;"""
+
+artist_table_insert = """INSERT INTO artists \
     (artist_id, name, location, latitude, longitude) SELECT \
-    DISTINCT(staging_songs.artist_id) as artist_id, \
-    staging_songs.artist_name as name, \
-    staging_songs.artist_location as location, \
-    staging_songs.artist_latitude as latitude, \
-    staging_songs.artist_longitude as longitude \
-    FROM {SCHEMA_NAME}.staging_songs;"""
-
-time_table_insert = f"""INSERT INTO {SCHEMA_NAME}.time \
+    artist_id, name, location, latitude, longitude FROM ( \
+        SELECT \
+        staging_songs.artist_id as artist_id, \
+        staging_songs.artist_name as name, \
+        staging_songs.artist_location as location, \
+        staging_songs.artist_latitude as latitude, \
+        staging_songs.artist_longitude as longitude, \
+        ROW_NUMBER() OVER (PARTITION BY staging_songs.artist_id \
+            ORDER BY staging_songs.artist_latitude NULLS LAST, \
+            staging_songs.artist_longitude NULLS LAST, \
+            NULLIF(staging_songs.artist_location, '') NULLS LAST, \
+            staging_songs.artist_name) as rn \
+        FROM staging_songs) AS unique_artists \
+    WHERE rn = 1;"""
+
+time_table_insert = """INSERT INTO time \
     (start_time, hour, day, week, month, year, weekday) SELECT \
     DISTINCT(songplays.start_time) as start_time, \
     EXTRACT(hour from songplays.start_time) as hour, \
@@ -125,21 +146,33 @@ time_table_insert = f"""INSERT INTO {SCHEMA_NAME}.time \
     EXTRACT(month from songplays.start_time) as month, \
     EXTRACT(year from songplays.start_time) as year, \
     EXTRACT(dow from songplays.start_time) as weekday \
-    FROM {SCHEMA_NAME}.songplays;"""
+    FROM songplays;"""
 
 # QUERY LISTS
 
-create_table_queries = [
-    staging_events_table_create,
-    staging_songs_table_create,
-    songplay_table_create,
-    user_table_create,
-    artist_table_create,
-    song_table_create,
-    time_table_create,
+# (table name, query) pairs, the plain query lists are derived from them
+create_table_specs = [
+    ("staging_events", staging_events_table_create),
+    ("staging_events_nextsong", staging_events_nextsong_table_create),
+    ("staging_songs", staging_songs_table_create),
+    ("songplays", songplay_table_create),
+    ("users", user_table_create),
+    ("artists", artist_table_create),
+    ("songs", song_table_create),
+    ("time", time_table_create),
+]
+insert_table_specs = [
+    ("songplays", songplay_table_insert),
+    ("users", user_table_insert),
+    ("songs", song_table_insert),
+    ("artists", artist_table_insert),
+    ("time", time_table_insert),
 ]
+
+create_table_queries = [query for _, query in create_table_specs]
 drop_table_queries = [
     songplay_table_drop,
+    staging_events_nextsong_table_drop,
     staging_events_table_drop,
     staging_songs_table_drop,
     user_table_drop,
@@ -148,10 +181,12 @@ drop_table_queries = [
     time_table_drop,
 ]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [
-    songplay_table_insert,
-    user_table_insert,
-    song_table_insert,
-    artist_table_insert,
-    time_table_insert,
+insert_table_queries = [query for _, query in insert_table_specs]
+
+# ANALYZE TABLES
+
+analyze_staging_table_queries = [
+    "ANALYZE staging_events_nextsong;",
+    "ANALYZE staging_songs;",
 ]
+analyze_table_queries = [f"ANALYZE {tbl_name};" for tbl_name, _ in insert_table_specs]